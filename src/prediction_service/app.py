@@ -1,9 +1,13 @@
+import time
+IMPORT_START_WALL = time.time()
+PROCESS_START = time.perf_counter()
+
 import os
-import mlflow
-import requests
-import logging 
+import pickle
+import logging
+import threading
+from importlib import import_module
 from flask import Flask, request, jsonify
-from pymongo import MongoClient
 
 
 # configure logger
@@ -24,29 +28,195 @@ if None in (RUN_ID, EXPERIMENT_ID, S3_BUCKET_NAME):
 EVIDENTLY_SERVICE_ADDRESS = os.environ.get('EVIDENTLY_SERVICE', 'http://127.0.0.1:5000')
 MONGODB_ADDRESS = os.environ.get("MONGODB_ADDRESS", "mongodb://127.0.0.1:27017")
 
-# load model from S3
-logging.info("Loading model from the artifact store")
-model_url = f"s3://{S3_BUCKET_NAME}/{EXPERIMENT_ID}/{RUN_ID}/artifacts/models"
-model = mlflow.pyfunc.load_model(model_url)
+# Env variables regarding the startup mode
+# LAZY_STARTUP=1 serves the health endpoints immediately and warms up the model in the background
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "0").lower() in ("1", "true", "yes")
+# target for the time between process start and the service being able to serve a prediction
+TTFP_TARGET_SEC = float(os.environ.get("TTFP_TARGET_SEC", "5"))
+# number of model load attempts and the initial delay between them, doubled after every failure
+WARMUP_ATTEMPTS = int(os.environ.get("WARMUP_ATTEMPTS", "3"))
+WARMUP_BACKOFF_SEC = float(os.environ.get("WARMUP_BACKOFF_SEC", "2"))
+
+MODEL_KEY = f"{EXPERIMENT_ID}/{RUN_ID}/artifacts/models/model.pkl"
+
+# startup state reported by the health endpoints
+timings = {}
+warmup_done = threading.Event()
+warmup_error = None
+first_request_done = False
+model = None
+mongo_collection = None
+requests_module = None
+# guards the lazily created monitoring clients and the first request timing
+state_lock = threading.Lock()
+
+
+def interpreter_startup_sec():
+    # time spent starting the interpreter and flask before this module was imported
+    try:
+        import psutil
+    except ImportError:
+        return 0.0
+    return max(IMPORT_START_WALL - psutil.Process().create_time(), 0.0)
+
+
+timings["interpreter_startup_sec"] = round(interpreter_startup_sec(), 4)
+# count the startup from the process creation instead of the module import
+PROCESS_START -= timings["interpreter_startup_sec"]
+
+
+def timed_import(module_name):
+    start = time.perf_counter()
+    module = import_module(module_name)
+    # keep the first measurement, repeated imports during retries are cached
+    timings.setdefault(f"import_{module_name.replace('.', '_')}_sec", round(time.perf_counter() - start, 4))
+    return module
+
+
+def load_model():
+    # fetch only the pickled sklearn pipeline logged by mlflow.sklearn.log_model,
+    # so the mlflow package itself is never imported by the service
+    boto3 = timed_import("boto3")
+    # import the modules of the pipeline up front, otherwise unpickling pays for them
+    timed_import("sklearn.pipeline")
+    timed_import("sklearn.feature_extraction")
+    timed_import("sklearn.linear_model")
+
+    logging.info(f"Loading model from s3://{S3_BUCKET_NAME}/{MODEL_KEY}")
+    start = time.perf_counter()
+    s3_object = boto3.client("s3").get_object(Bucket=S3_BUCKET_NAME, Key=MODEL_KEY)
+    loaded_model = pickle.loads(s3_object["Body"].read())
+    timings["load_model_sec"] = round(time.perf_counter() - start, 4)
+    return loaded_model
+
+
+def load_model_with_retries():
+    delay = WARMUP_BACKOFF_SEC
+    for attempt in range(1, WARMUP_ATTEMPTS + 1):
+        timings["warmup_attempts"] = attempt
+        try:
+            return load_model()
+        except Exception:
+            if attempt == WARMUP_ATTEMPTS:
+                raise
+            logging.exception(f"Failed to load the model (attempt {attempt}/{WARMUP_ATTEMPTS}), retrying in {delay}s")
+            time.sleep(delay)
+            delay *= 2
+
+
+def warm_up():
+    global model, warmup_error
+    try:
+        model = load_model_with_retries()
+        timings["warmup_total_sec"] = round(time.perf_counter() - PROCESS_START, 4)
+        logging.info(f"Model is ready, startup timings: {timings}")
+    except Exception as exc:
+        warmup_error = repr(exc)
+        logging.exception("Failed to warm up the prediction service")
+        return
+    finally:
+        warmup_done.set()
+
+    # the service is ready at this point, the monitoring clients are prepared
+    # afterwards so that the first prediction does not pay for them
+    try:
+        get_collection()
+        get_requests()
+    except Exception:
+        logging.exception("Failed to prepare the monitoring clients")
+    record_time_to_serve()
+
+
+def get_collection():
+    # pymongo is imported and the client is created once, normally by the warm-up
+    global mongo_collection
+    with state_lock:
+        if mongo_collection is None:
+            pymongo = timed_import("pymongo")
+            logging.info("Configuring the MongoDB client")
+            mongo_client = pymongo.MongoClient(MONGODB_ADDRESS)
+            db = mongo_client.get_database("prediction_service")
+            mongo_collection = db.get_collection("bixi_prediction")
+    return mongo_collection
+
+
+def get_requests():
+    global requests_module
+    with state_lock:
+        if requests_module is None:
+            requests_module = timed_import("requests")
+    return requests_module
+
 
 def predict(features):
     preds = model.predict(features)
     return float(preds[0])
 
 
+def record_time_to_serve():
+    # time until a prediction can be served with the model and the monitoring clients ready
+    time_to_serve = round(time.perf_counter() - PROCESS_START, 4)
+    timings["time_to_serve_sec"] = time_to_serve
+    if time_to_serve > TTFP_TARGET_SEC:
+        logging.warning(f"Time to serve the first prediction {time_to_serve}s exceeded the target of {TTFP_TARGET_SEC}s")
+    else:
+        logging.info(f"Time to serve the first prediction {time_to_serve}s is within the target of {TTFP_TARGET_SEC}s")
+
+
+def record_first_request(request_start):
+    # latency of the first prediction request, independent of when traffic starts
+    global first_request_done
+    with state_lock:
+        if first_request_done:
+            return
+        first_request_done = True
+        timings["first_request_latency_sec"] = round(time.perf_counter() - request_start, 4)
+
+
 # create the flask app
 bixi_app = Flask('bixi-ride-duration-prediction')
 
-# initial the monitoring objects
-logging.info("Configuring the MongoDB client")
-mongo_client = MongoClient(MONGODB_ADDRESS)
-db = mongo_client.get_database("prediction_service")
-collection = db.get_collection("bixi_prediction")
+if LAZY_STARTUP:
+    logging.info("Lazy startup enabled, warming up the model in the background")
+    threading.Thread(target=warm_up, name="model-warmup", daemon=True).start()
+else:
+    warm_up()
+    if warmup_error is not None:
+        raise RuntimeError(f"Failed to load the model: {warmup_error}")
+
+
+@bixi_app.route('/health/live', methods=['GET'])
+def liveness():
+    uptime = round(time.perf_counter() - PROCESS_START, 4)
+    # a failed warm-up never recovers, let the orchestrator restart the container
+    if warmup_error is not None:
+        return jsonify({'status': 'failed', 'error': warmup_error, 'uptime_sec': uptime}), 503
+    return jsonify({'status': 'alive', 'uptime_sec': uptime})
+
+
+@bixi_app.route('/health/ready', methods=['GET'])
+def readiness():
+    ready = warmup_done.is_set() and warmup_error is None
+    status = {
+        'ready': ready,
+        'warming_up': not warmup_done.is_set(),
+        'error': warmup_error,
+        'model_version': RUN_ID,
+        'ttfp_target_sec': TTFP_TARGET_SEC,
+        'timings': timings
+    }
+    return jsonify(status), 200 if ready else 503
+
 
 # create the prediciton endpoint
 @bixi_app.route('/predict', methods=['POST'])
 def duration_prediction():
 
+    request_start = time.perf_counter()
+    # do not hold a server thread while the model is warming up
+    if not warmup_done.is_set() or warmup_error is not None:
+        return jsonify({'error': 'model is not ready', 'detail': warmup_error}), 503
+
     trip_details = request.get_json()
     duration = predict(trip_details)
 
@@ -63,19 +233,21 @@ def duration_prediction():
     logging.info("Sending prediction log to the Evidently AI service")
     send_to_evidently_service(trip_details, float(duration))
 
+    # measured once the whole first response, including the monitoring logs, is built
+    record_first_request(request_start)
     return jsonify(prediction)
 
 
 def save_to_db(record, prediction):
     rec = record.copy()
     rec["duration_minute"] = prediction
-    collection.insert_one(rec)
+    get_collection().insert_one(rec)
 
 
 def send_to_evidently_service(record, prediction):
     rec = record.copy()
     rec["duration_minute"] = prediction
-    requests.post(f"{EVIDENTLY_SERVICE_ADDRESS}/iterate/bixi", json=[rec])
+    get_requests().post(f"{EVIDENTLY_SERVICE_ADDRESS}/iterate/bixi", json=[rec])
 
 
 # start the flask app
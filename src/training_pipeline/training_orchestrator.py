@@ -1,6 +1,8 @@
 from time import timezone
 import mlflow
 import os
+import tempfile
+import numpy as np
 import pandas as pd
 import haversine as hs
 
@@ -14,6 +16,12 @@ from prefect.orion.schemas.schedules import CronSchedule
 from datetime import timedelta
 
 
+# bucket edges used by the grouped evaluation report
+DISTANCE_BINS_KM = [0, 1, 2, 3, 5, 10, np.inf]
+DISTANCE_LABELS = ["0-1", "1-2", "2-3", "3-5", "5-10", ">10"]
+PAIR_POPULARITY_BINS = [-np.inf, 0, 10, 100, 1000, np.inf]
+PAIR_POPULARITY_LABELS = ["unseen", "1-10", "11-100", "101-1000", ">1000"]
+
 @task
 def read_data(path: str, date_columns: list[int], header_col:int = 0) -> pd.DataFrame:
     return pd.read_csv(path, header=header_col, parse_dates=date_columns)
@@ -46,18 +54,20 @@ def preprocess_data(ride_df: pd.DataFrame, station_df: pd.DataFrame)-> pd.DataFr
     # convert the duration to minute
     end_station_df["duration_minute"] = end_station_df["duration_sec"]/60
     
-    # select the final columns
-    processed_df = end_station_df[["ride_stations", "distance_km", "is_member", "duration_minute"]]
+    # select the final columns, the start station is kept for the evaluation report only
+    processed_df = end_station_df[["emplacement_pk_start", "ride_stations", "distance_km", "is_member", "duration_minute"]]
     # convert the categorical column to string
     processed_df["is_member"] = processed_df["is_member"].astype(str)
     
     return processed_df
 
 @task
-def generate_features(input_df: pd.DataFrame, target_column: str):
+def generate_features(input_df: pd.DataFrame, target_column: str, drop_columns: tuple[str, ...] = ()):
     
     feature_columns = input_df.columns.to_list()
     feature_columns.remove(target_column)
+    # remove the columns which are not model features
+    feature_columns = [column for column in feature_columns if column not in drop_columns]
     # crate a data frame with train columns
     feature_df = input_df[feature_columns]
     
@@ -79,6 +89,46 @@ def build_model(X, y, alpha):
     # return the pipeline
     return pipeline
 
+@task
+def evaluate_by_group(valid_df: pd.DataFrame, y_pred: np.ndarray, target_column: str, train_df: pd.DataFrame) -> pd.DataFrame:
+
+    # encode the station pairs once, everything else is derived from the categories
+    pairs = valid_df["ride_stations"].astype("category")
+    pair_categories = pairs.cat.categories
+
+    # popularity of a station pair is its number of rides in the training data
+    pair_counts = train_df["ride_stations"].value_counts().reindex(pair_categories, fill_value=0)
+    popularity = pd.cut(pair_counts, bins=PAIR_POPULARITY_BINS, labels=PAIR_POPULARITY_LABELS)
+
+    error = y_pred.astype(np.float32) - valid_df[target_column].to_numpy(dtype=np.float32)
+    eval_df = pd.DataFrame({
+        "start_station": valid_df["emplacement_pk_start"].astype("category").values,
+        "pair_popularity": pd.Categorical.from_codes(popularity.cat.codes.to_numpy()[pairs.cat.codes.to_numpy()], popularity.cat.categories),
+        "distance_bucket": pd.cut(valid_df["distance_km"].to_numpy(), bins=DISTANCE_BINS_KM, labels=DISTANCE_LABELS, include_lowest=True),
+        "is_member": valid_df["is_member"].astype("category").values,
+        "squared_error": np.square(error),
+        "absolute_error": np.abs(error)
+    })
+
+    reports = []
+    for dimension in ["start_station", "pair_popularity", "distance_bucket", "is_member"]:
+        grouped = eval_df.groupby(dimension, observed=True).agg(
+            n_rides=("squared_error", "size"),
+            mse=("squared_error", "mean"),
+            mae=("absolute_error", "mean")
+        )
+        reports.append(pd.DataFrame({
+            "dimension": dimension,
+            "group": grouped.index.astype(str),
+            "n_rides": grouped["n_rides"].to_numpy(),
+            "rmse": np.sqrt(grouped["mse"].to_numpy()),
+            "mae": grouped["mae"].to_numpy()
+        }))
+
+    report_df = pd.concat(reports, ignore_index=True)
+    report_df["dimension"] = report_df["dimension"].astype("category")
+    return report_df
+
 @flow
 def train_and_register_model(train_ride_path: str, 
                              train_station_path: str,
@@ -121,10 +171,10 @@ def train_and_register_model(train_ride_path: str,
     
     # generate features
     print("Generating features")
-    X_train = generate_features(input_df=train_preprocessed_df, target_column="duration_minute")
+    X_train = generate_features(input_df=train_preprocessed_df, target_column="duration_minute", drop_columns=("emplacement_pk_start",))
     y_train = train_preprocessed_df["duration_minute"].values
 
-    X_val = generate_features(input_df=valid_preprocessed_df, target_column="duration_minute")
+    X_val = generate_features(input_df=valid_preprocessed_df, target_column="duration_minute", drop_columns=("emplacement_pk_start",))
     y_val = valid_preprocessed_df["duration_minute"].values
     
     # set the experiment name
@@ -153,6 +203,15 @@ def train_and_register_model(train_ride_path: str,
         rmse = mean_squared_error(y_val, y_pred, squared=False)
         mlflow.log_metric("rmse", rmse)
         print(f"RMSE on the validation data: {rmse}")
+
+        # break the errors down by station, pair popularity, distance and membership
+        print("Computing the grouped evaluation report")
+        report_df = evaluate_by_group(valid_preprocessed_df, y_pred, "duration_minute", train_preprocessed_df)
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_path = os.path.join(report_dir, "grouped_evaluation.parquet")
+            report_df.to_parquet(report_path, index=False)
+            mlflow.log_artifact(report_path, artifact_path="evaluation")
+        print("Logged the grouped evaluation report in artifacts")
         
         # log the model and the dictvectorize
         mlflow.sklearn.log_model(model, artifact_path="models")